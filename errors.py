@@ -1,2 +1,5 @@
 class IdsrvXsrfNotFound(Exception):
+    pass
+
+class ReloginFailed(Exception):
     pass
\ No newline at end of file
@@ -1,14 +1,53 @@
-import json
 import os
+import pickle
 import re
+import tempfile
+import time
 from collections import namedtuple
+from functools import lru_cache
+from operator import itemgetter
 
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from errors import IdsrvXsrfNotFound
+from errors import IdsrvXsrfNotFound, ReloginFailed
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0'
+
+# only advertise encodings requests can decode (br needs the optional brotli package)
+ACCEPT_ENCODING = requests.utils.default_headers()['Accept-Encoding']
+
+# Medicover session expires after 10 minutes without activity
+SESSION_TIMEOUT_MINUTES = 10
+
+SEARCH_URL = 'https://mol.medicover.pl/api/MyVisits/SearchFreeSlotsToBook'
+# built once, requests merges them with session headers on every search
+SEARCH_HEADERS = {
+    'Host': 'mol.medicover.pl',
+    'Accept': '*/*',
+    'Accept-Encoding': ACCEPT_ENCODING,
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Content-Type': 'application/json',
+    'X-Requested-With': 'XMLHttpRequest',
+    'Referer': 'https://mol.medicover.pl/MyVisits'
+}
+
+# session cookies are kept here between runs, one file per user
+COOKIES_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'medihunter')
+# fixed rather than HIGHEST_PROTOCOL, so files stay readable by every supported Python (3.7 lacks 5)
+PICKLE_PROTOCOL = 4
+
+# hidden inputs posted back from the OAuth form
+TOKEN_FORM_FIELDS = ['code', 'id_token', 'scope', 'session_state', 'state']
+
+# opening and closing script tags around the login page model json
+SCRIPT_TAG_RE = re.compile(r'</?script.*?>')
 
 Appointment = namedtuple('Appointment', ['doctor_name', 'clinic_name', 'appointment_datetime'])
+# search result fields in Appointment order
+APPOINTMENT_FIELDS = itemgetter('doctorName', 'clinicName', 'appointmentDate')
 
 class MedicoverSession():
     """
@@ -18,12 +57,23 @@ class MedicoverSession():
     def __init__(self, username, password):
         self.username = username
         self.password = password
+        self.resumed = False
+        # cookies are only saved for sessions with search form loaded, so resumed ones can skip it
+        self.search_form_loaded = False
+        # set once this process wrote the cookie file, only then log_out removes it
+        self.cookies_saved = False
         self.session = requests.Session()
+        # one keep-alive pool per host (mol. and oauth.medicover.pl) reused for the whole hunt,
+        # idempotent requests are retried on dropped connections and gateway errors
+        retries = Retry(total=3, backoff_factor=0.3,
+                        status_forcelist=[502, 503, 504], raise_on_status=False)
+        self.session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=4,
+                                                   max_retries=retries))
         self.headers = {
-            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0',
+            'User-Agent': USER_AGENT,
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
             'Accept-Language': 'pl,en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip, deflate, br',
+            'Accept-Encoding': ACCEPT_ENCODING,
             'Connection': 'keep-alive',
             'Upgrade-Insecure-Requests': '1'
         }
@@ -37,53 +87,104 @@ class MedicoverSession():
             'username': self.username,
             'password': self.password
         }
-        if 'idsrv.xsrf' in page_text:
-            for line in page_text.split('\n'):
-                if 'idsrv.xsrf' in line:
-                    line = line.replace('&quot;', '"')
-                    line = line.replace('</script>', '')
-                    line = re.sub(r'<script.*?>', '', line)
-                    dzej_son = json.loads(line)
-                    xsrf = dzej_son['antiForgery']['value']
-                    data['idsrv.xsrf'] = xsrf
-                    break
-        else:
+        # locate the line with the token directly instead of splitting the whole page into lines
+        position = page_text.find('idsrv.xsrf')
+        if position == -1:
             raise IdsrvXsrfNotFound
+        line_start = page_text.rfind('\n', 0, position) + 1
+        line_end = page_text.find('\n', position)
+        line = page_text[line_start:] if line_end == -1 else page_text[line_start:line_end]
+
+        line = line.replace('&quot;', '"')
+        line = SCRIPT_TAG_RE.sub('', line)
+        dzej_son = orjson.loads(line)
+        xsrf = dzej_son['antiForgery']['value']
+        data['idsrv.xsrf'] = xsrf
         return data
 
-    def oauth_sign_in(self, page_text):
+    def oauth_sign_in(self, page):
         """
-            Helper function allowing to extract oauth link from page content
+            Helper function allowing to extract oauth link from page content (text or parsed form)
         """
-        soup = BeautifulSoup(page_text, 'html.parser')
+        soup = parse_form(page)
         return soup.form['action']
 
 
-    def token_form_data(self, page_text):
+    def token_form_data(self, page):
         """
             Helper function allowing to extract code, token, scope, state and session_state from
-            page content
+            page content (text or parsed form)
+        """
+        soup = parse_form(page)
+        inputs = soup.form.find_all('input', attrs={'name': TOKEN_FORM_FIELDS})
+        return {tag['name']: tag.get('value', '') for tag in inputs}
+
+    def _cookies_path(self):
+        return os.path.join(COOKIES_DIR, f'{self.username}.cookies')
+
+    def save_cookies(self):
+        """
+            Store session cookies so that next run can reuse the session
+            The cache is optional, failing to write it is reported and doesn't stop the hunt
+        """
+        tmp_path = None
+        try:
+            os.makedirs(COOKIES_DIR, exist_ok=True)
+            # unique tmp file (created with 0600), other processes of the same user save too
+            fd, tmp_path = tempfile.mkstemp(dir=COOKIES_DIR, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(self.session.cookies, f, protocol=PICKLE_PROTOCOL)
+            os.replace(tmp_path, self._cookies_path())
+        except OSError as e:
+            print(f'Saving session cookies failed: {e}')
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return
+        self.cookies_saved = True
+
+    def load_cookies(self):
         """
-        o = dict()
-        soup = BeautifulSoup(page_text, 'html.parser')
-        for descet in soup.form.descendants:
-            if descet.name == 'input':
-                if descet['name'] == 'code':
-                    o['code'] = descet['value']
-                elif descet['name'] == 'id_token':
-                    o['id_token'] = descet['value']
-                elif descet['name'] == 'scope':
-                    o['scope'] = descet['value']
-                elif descet['name'] == 'session_state':
-                    o['session_state'] = descet['value']
-                elif descet['name'] == 'state':
-                    o['state'] = descet['value']
-        return o
-
-    def log_in(self):
+            Restore cookies stored by save_cookies
+            Returns False if there was nothing to restore or the session has already expired
+        """
+        cookies_path = self._cookies_path()
+        try:
+            # cookies are saved on every search, so an old file means an expired session
+            if time.time() - os.path.getmtime(cookies_path) > SESSION_TIMEOUT_MINUTES * 60:
+                return False
+            with open(cookies_path, 'rb') as f:
+                cookies = pickle.load(f)
+        except Exception:
+            # unreadable, written by an incompatible Python/requests etc., just log in again
+            return False
+        self.session.cookies.update(cookies)
+        return True
+
+    def resume_session(self):
+        """
+            Reuse cookies from previous run without asking Medicover website if they are valid,
+            the first search does it anyway (see search_appointments)
+            Returns True if cookies were restored
+        """
+        self.resumed = self.load_cookies()
+        self.search_form_loaded = self.resumed
+        return self.resumed
+
+    def log_in(self, resume=True):
         """
             Login to Medicover website
+            Session from previous run is reused when it has not expired yet
         """
+        if resume and self.resume_session():
+            return None
+
+        self.resumed = False
+        self.search_form_loaded = False
+        self.session.cookies.clear()
+
         #TODO: this method needs to be cleaned
 
         # 1. GET https://mol.medicover.pl/Users/Account/LogOn?ReturnUrl=%2F
@@ -120,8 +221,10 @@ class MedicoverSession():
         response = self.session.get(
             next_url, headers=self.headers, allow_redirects=False)
         self.session.headers.update({'Referer': next_url})
-        next_url = self.oauth_sign_in(response.text)
-        data = self.token_form_data(response.text)
+        # the page is parsed once for both the form action and its inputs
+        form = parse_form(response.text)
+        next_url = self.oauth_sign_in(form)
+        data = self.token_form_data(form)
         self.session.headers.update(
             {'Content-Type': 'application/x-www-form-urlencoded'})
 
@@ -138,8 +241,10 @@ class MedicoverSession():
             next_url, headers=self.headers, data=data, allow_redirects=False)
 
         # 8. GET https://mol.medicover.pl/
-        response = self.session.get(
-            next_url, headers=self.headers, data=data, allow_redirects=False)
+        # repeated only when the first request didn't land on the home page yet
+        if response.status_code != 200:
+            response = self.session.get(
+                next_url, headers=self.headers, data=data, allow_redirects=False)
         return response
 
     def _parse_search_results(self, result):
@@ -147,19 +252,19 @@ class MedicoverSession():
         take search results in json format end transporm it to list of namedtuples
         """
     
-        result = result.json()
-        result = result['items']
-        appointments = []
-
-        for r in result:
-            appointment = Appointment(
-                doctor_name=r['doctorName'], 
-                clinic_name=r['clinicName'], 
-                appointment_datetime=r['appointmentDate']
-            )
-            appointments.append(appointment)
-
-        return appointments        
+        items = orjson.loads(result.content)['items']
+        make_appointment = Appointment._make
+        return [make_appointment(APPOINTMENT_FIELDS(r)) for r in items]
+
+    def _post_search(self, body):
+        # not logged in users are redirected to the login page, which must not be followed
+        return self.session.post(
+            SEARCH_URL,
+            data=body,
+            params={'language': 'pl-PL'},
+            headers=SEARCH_HEADERS,
+            allow_redirects=False
+        )
 
     def search_appointments(self, *args, **kwargs):
 
@@ -172,24 +277,11 @@ class MedicoverSession():
             return
         
 
-        BASE_URL = 'mol.medicover.pl'
-        headers = self.session.headers
-        headers.update({
-            'Host': BASE_URL,
-            'Accept': '*/*',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Content-Type': 'application/json',
-            'X-Requested-With': 'XMLHttpRequest',
-            'Referer': 'https://mol.medicover.pl/MyVisits'
-            })
-    
-
-        region_id = int(kwargs['region'])
+        region_id = kwargs['region']
         service_ids = [int(kwargs['specialization'])] if kwargs['bookingtype'] == 2 else [
             int(kwargs['service'])]
-        clinic_ids = [kwargs['clinic']] if kwargs['clinic'] > 0 else []
-        doctor_ids = [kwargs['doctor']] if kwargs['doctor'] > 0 else []
+        clinic_ids = search_ids(kwargs['clinic'])
+        doctor_ids = search_ids(kwargs['doctor'])
 
         search_params = {
             "regionIds": [region_id],
@@ -198,25 +290,45 @@ class MedicoverSession():
             "clinicIds": clinic_ids,
             "doctorLanguagesIds": [],
             "doctorIds": doctor_ids,
+            # open-ended range, so a single request covers every day from start_date on
             "searchSince": kwargs['start_date'],
         }
    
-        result = self.session.post(
-            f'https://{BASE_URL}/api/MyVisits/SearchFreeSlotsToBook', 
-            json=search_params, 
-            params={'language': 'pl-PL'},
-            headers=headers
-        )
-        
+        # serialized once with orjson (Content-Type is set in SEARCH_HEADERS), also for the retry
+        body = orjson.dumps(search_params)
+        result = self._post_search(body)
+        if result.status_code != 200:
+            # session is no longer accepted (e.g. expired or ended by another run
+            # sharing saved cookies), log in and search again
+            try:
+                self.log_in(resume=False)
+                self.load_search_form()
+            except Exception as e:
+                raise ReloginFailed from e
+            result = self._post_search(body)
+        # searching extends the session, keep saved cookies in line with it
+        if self.search_form_loaded:
+            self.save_cookies()
+
         return self._parse_search_results(result)
 
     def load_search_form(self):
-        return self.session.get(
+        """
+            Open visits search page to initialize search in the session
+            Skipped for resumed sessions, cookies are saved only after it succeeded
+        """
+        if self.search_form_loaded:
+            return None
+        response = self.session.get(
             'https://mol.medicover.pl/MyVisits',
             params={'bookingTypeId': 2,
                     'mex': 'True',
                     'pfm': 1}
         )
+        if response.ok:
+            self.search_form_loaded = True
+            self.save_cookies()
+        return response
 
     def log_out(self):
         """
@@ -229,8 +341,43 @@ class MedicoverSession():
         #print(self.headers)
         response = self.session.get(next_url, headers=self.headers)
         self.session.close()
+        if self.cookies_saved:
+            try:
+                os.remove(self._cookies_path())
+            except OSError:
+                pass
         return response
 
+def parse_form(page):
+    """
+    Parse <form> of the page, already parsed pages are returned as they are
+    """
+    # bs4 is only needed when logging in, don't load it for resumed sessions or show-params
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    if isinstance(page, BeautifulSoup):
+        return page
+    # only the <form> is needed, the rest of the page is not turned into soup
+    return BeautifulSoup(page, 'lxml', parse_only=SoupStrainer('form'))
+
+def search_ids(value):
+    """
+    Turn a single id or a collection of ids into the list expected by the search API.
+    Non-positive ids (-1 by default) mean "any" and are skipped.
+    """
+    values = value if isinstance(value, (list, tuple)) else [value]
+    return [int(v) for v in values if int(v) > 0]
+
+@lru_cache(maxsize=1)
+def _load_params_file():
+    """
+    Read and parse ids/params.json once per process
+    """
+    params_path = os.path.join(os.path.dirname(__file__), 'ids/params.json')
+
+    with open(params_path, 'rb') as f:
+        return orjson.loads(f.read())
+
 def load_available_search_params(field_name):
     FIELDS_NAMES = {
         'specialization': 'availableSpecializations',
@@ -244,13 +391,4 @@ def load_available_search_params(field_name):
 
     field_name = FIELDS_NAMES[field_name]
 
-    params_file_content = ''
-    
-    params_path = os.path.join(os.path.dirname(__file__), 'ids/params.json')
-
-    with open(params_path) as f:
-        params_file_content = f.read()
-
-    params = json.loads(params_file_content)
-
-    return params[field_name]
+    return _load_params_file()[field_name]
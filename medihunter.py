@@ -2,19 +2,30 @@
 this is a startpoint for adding new features
 """
 
-import json
+import os
+import random
 import time
-from datetime import datetime
-from typing import Callable, List
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date
+from typing import Callable, List, Optional
 
 import click
 
-from medicover_session import (Appointment, MedicoverSession,
-                               load_available_search_params)
-from medihunter_notifiers import pushover_notify, telegram_notify
+from errors import ReloginFailed
+from medicover_session import (SESSION_TIMEOUT_MINUTES, Appointment,
+                               MedicoverSession, load_available_search_params)
 
-now = datetime.now()
-now_formatted = now.strftime('%Y-%m-%dT02:00:00.000Z')
+
+def default_start_date() -> str:
+    return f'{date.today().isoformat()}T02:00:00.000Z'
+
+
+now_formatted = default_start_date()
+
+# the oldest appointments are forgotten once this many were seen
+MAX_REMEMBERED_APPOINTMENTS = 50000
 
 
 def make_duplicate_checker() -> Callable[[Appointment], bool]:
@@ -24,12 +35,16 @@ def make_duplicate_checker() -> Callable[[Appointment], bool]:
         True if appointment ocurred first time
         False otherwise
     """
-    found_appointments: List[Appointment] = []
+    found_appointments: 'OrderedDict[Appointment, None]' = OrderedDict()
 
     def duplicate_checker(appointment: Appointment) -> bool:
         if appointment in found_appointments:
+            # still listed, so it is the most recently seen and evicted last
+            found_appointments.move_to_end(appointment)
             return False
-        found_appointments.append(appointment)
+        found_appointments[appointment] = None
+        if len(found_appointments) > MAX_REMEMBERED_APPOINTMENTS:
+            found_appointments.popitem(last=False)
         return True
 
     return duplicate_checker
@@ -37,33 +52,98 @@ def make_duplicate_checker() -> Callable[[Appointment], bool]:
 
 duplicate_checker = make_duplicate_checker()
 
+# notifications are sent in the background (one at a time, in order)
+# so that the next search is not delayed by the notification service
+notification_executor = ThreadPoolExecutor(max_workers=1)
+
+def echo_error(message: str, exc: Optional[BaseException] = None):
+    """Prints error message, with the traceback of exc (or of the exception
+    being handled when called from an except block) only when
+    MEDIHUNTER_DEBUG=1 is exported
+    """
+    click.secho(message, fg='red')
+    if os.environ.get('MEDIHUNTER_DEBUG') == '1':
+        if exc is None:
+            details = traceback.format_exc()
+        else:
+            details = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        click.echo(details, err=True)
+
+
 def notify_external_device(message: str, notifier: str):
     # TODO: add more notification providiers
+    # notifiers package is slow to import, it is loaded by find_appointment only when enabled
+    from medihunter_notifiers import pushover_notify, telegram_notify
+
     if notifier == 'pushover':
         pushover_notify(message)
     elif notifier == 'telegram':
         telegram_notify(message)
 
 
-def process_appointments(appointments: List[Appointment], iteration_counter: int, notifier: str):
+def report_notification_error(future: Future):
+    """Done callback of background notifications, reports their failures"""
+    exc = future.exception()
+    if exc is not None:
+        echo_error(f'Sending notification failed: {exc}', exc)
+
+
+def process_appointments(appointments: List[Appointment], iteration_counter: int, notifier: str) -> bool:
+    """Prints and notifies about appointments which were not seen before
+
+    Returns:
+        True if any new appointment was found
+        False otherwise
+    """
 
     applen = len(appointments)
     click.echo(click.style(
         f'(iteration: {iteration_counter}) Found {applen} appointments', fg='green', blink=True))
     
-    notification_message = ''
-
-    for appointment in appointments:
-        if duplicate_checker(appointment):
-            click.echo(
-                appointment.appointment_datetime + ' ' +
-                click.style(appointment.doctor_name, fg='bright_green') + ' ' +
-                appointment.clinic_name
-            )
-            notification_message += f'{appointment.appointment_datetime} {appointment.doctor_name} {appointment.clinic_name}\n'
-    
-    if notification_message:
-        notify_external_device(notification_message, notifier)
+    new_appointments = [
+        appointment for appointment in appointments if duplicate_checker(appointment)]
+
+    if not new_appointments:
+        return False
+
+    # whole batch is written at once instead of one write per appointment
+    click.echo('\n'.join(
+        appointment.appointment_datetime + ' ' +
+        click.style(appointment.doctor_name, fg='bright_green') + ' ' +
+        appointment.clinic_name
+        for appointment in new_appointments
+    ))
+
+    notification_message = ''.join(
+        f'{appointment.appointment_datetime} {appointment.doctor_name} {appointment.clinic_name}\n'
+        for appointment in new_appointments
+    )
+    if notifier:
+        future = notification_executor.submit(
+            notify_external_device, notification_message, notifier)
+        future.add_done_callback(report_notification_error)
+    return True
+
+
+def adaptive_interval(interval: int, miss_streak: int) -> float:
+    """Seconds to wait before the next search
+
+    Polls twice as often right after new appointments were found and backs
+    off up to 4x while nothing new shows up, but never past the session timeout
+    (intervals longer than the timeout are not extended at all).
+    """
+    if miss_streak == 0:
+        minutes = interval / 2
+    else:
+        minutes = interval * (1 << min(miss_streak, 2))
+        if interval >= SESSION_TIMEOUT_MINUTES:
+            minutes = interval
+    # up to 10% jitter so that polls don't line up with other hunters
+    delay = minutes * 60 * random.uniform(1, 1.1)
+    if interval < SESSION_TIMEOUT_MINUTES:
+        # capped after the jitter, so the session can't expire between searches
+        delay = min(delay, (SESSION_TIMEOUT_MINUTES - 1) * 60)
+    return delay
 
 
 def validate_arguments(**kwargs) -> bool:
@@ -80,14 +160,19 @@ def validate_arguments(**kwargs) -> bool:
 
 
 @click.command()
-@click.option('--region', '-r', required=True, show_default=True)
+@click.option('--region', '-r', type=int, required=True, show_default=True)
 @click.option('--bookingtype', '-b', default=2, show_default=True)
 @click.option('--specialization', '-s', default=-1)
-@click.option('--clinic', '-c', default=-1)
-@click.option('--doctor', '-o', default=-1)
+@click.option('--clinic', '-c', type=int, multiple=True, default=[-1])
+@click.option('--doctor', '-o', type=int, multiple=True, default=[-1])
 @click.option('--start-date', '-d', default=now_formatted, show_default=True)
 @click.option('--service', '-e', default=-1)
-@click.option('--interval', '-i', default=0, show_default=True)
+@click.option('--interval', '-i', default=0, show_default=True,
+              help='Base minutes between searches: halved after new appointments, '
+                   'backs off to 2x/4x while nothing new shows up, '
+                   'below 10 never longer than 9 minutes (session timeout)')
+@click.option('--fixed-interval', is_flag=True,
+              help='Always wait exactly --interval minutes between searches')
 @click.option('--enable-notifier', '-n', type=click.Choice(['pushover', 'telegram']))
 @click.option('--user', prompt=True)
 @click.password_option(confirmation_prompt=False)
@@ -101,6 +186,7 @@ def find_appointment(user,
                      start_date,
                      service,
                      interval,
+                     fixed_interval,
                      enable_notifier):
     
     valid = validate_arguments(
@@ -112,38 +198,61 @@ def find_appointment(user,
     if not valid:
         return
 
+    if enable_notifier:
+        # fail at startup rather than in the background on the first hit
+        try:
+            import medihunter_notifiers  # noqa: F401
+        except Exception:
+            echo_error('Notifier not initialized correctly')
+            return
+
     iteration_counter = 1
     med_session = MedicoverSession(username=user, password=password)
 
     try:
         med_session.log_in()
     except Exception:
-        click.secho('Unsuccessful logging in', fg='red')
+        echo_error('Unsuccessful logging in')
         return
 
     click.echo('Logged in')
 
     med_session.load_search_form()
 
-    while interval > 0 or iteration_counter < 2:
-        appointments = med_session.search_appointments(
-            region=region, 
-            bookingtype=bookingtype,
-            specialization=specialization, 
-            clinic=clinic, 
-            doctor=doctor,
-            start_date=start_date,
-            service=service)
+    miss_streak = 0
+    # default start date moves on with the calendar during long hunts
+    follow_today = start_date == now_formatted
 
+    while interval > 0 or iteration_counter < 2:
+        iteration_start = time.monotonic()
+        if follow_today:
+            start_date = default_start_date()
+        try:
+            appointments = med_session.search_appointments(
+                region=region, 
+                bookingtype=bookingtype,
+                specialization=specialization, 
+                clinic=clinic, 
+                doctor=doctor,
+                start_date=start_date,
+                service=service)
+        except ReloginFailed:
+            echo_error('Unsuccessful logging in')
+            return
+
+        found_new = False
         if not appointments:
             click.echo(click.style(
                 f'(iteration: {iteration_counter}) No results found', fg='yellow'))
         else:
-            process_appointments(
+            found_new = process_appointments(
                 appointments, iteration_counter, notifier=enable_notifier)
 
+        miss_streak = 0 if found_new else miss_streak + 1
         iteration_counter += 1
-        time.sleep(interval*60)
+        delay = interval * 60 if fixed_interval else adaptive_interval(interval, miss_streak)
+        # time spent on searching, printing and notifying counts towards the interval
+        time.sleep(max(0, iteration_start + delay - time.monotonic()))
 
 
 FIELD_NAMES = ['specialization', 'region', 'clinic', 'doctor']
@@ -4,20 +4,20 @@ When all features like notifications and multiple clinic/doctor
 search move to medihunter this script is going to be abandoned.
 """
 
-import json
 import time
 import shelve
 from datetime import datetime
-from pushover import Client
 
 import click
 
-from medicover_session import MedicoverSession, load_available_search_params
+from errors import ReloginFailed
+from medicover_session import PICKLE_PROTOCOL, MedicoverSession
+from medihunter import default_start_date, echo_error, show_params
 
 
 now = datetime.now()
-now_formatted = now.strftime('%Y-%m-%dT02:00:00.000Z')
-now_formatted_logging = now.strftime('%Y-%m-%d %H:%M:%S')
+now_formatted = default_start_date()
+now_formatted_logging = now.isoformat(' ', 'seconds')
 
 @click.command()
 @click.option('--user', prompt=True)
@@ -57,18 +57,21 @@ def find_appointment(
     # Checking if pushover is enabled and notifications should be send later
     if pushover_user and pushover_token:
         try :
+            from pushover import Client
             client = Client(user_key=pushover_user, api_token=pushover_token)
             pushover_notification = True
         except Exception:
-            click.secho('Pushover not initialized correctly', fg='red')
+            echo_error('Pushover not initialized correctly')
             return
     else :
         pushover_notification = False
 
     try :
-        med_session.log_in()
+        # own session: cookies saved by other runs (e.g. a running medihunter.py hunt) are not reused,
+        # as this script logs out at the end
+        med_session.log_in(resume=False)
     except Exception:
-        click.secho('Unsuccessful logging in', fg='red')
+        echo_error('Unsuccessful logging in')
         return
 
     click.echo(f'{now_formatted_logging}: Logged in {pushover_msgtitle}')
@@ -78,46 +81,51 @@ def find_appointment(
     while interval > 0 or counter < 1:
         notification = ""
         notificationcounter = 0
-        for c in clinic:
-            for d in doctor:
-                appointments = med_session.search_appointments(
-                    region=region, bookingtype=bookingtype, specialization=specialization, service=service, clinic=c, doctor=d, start_date=start_date)
-
-                if not appointments:
-                    click.echo(click.style(
-                        f'(iteration: {counter}) No results found ' + pushover_msgtitle, fg='yellow'))
-                else:
-                    applen = len(appointments)                    
-                    click.echo(click.style(f'(iteration: {counter}) Found {applen} appointments ' + pushover_msgtitle, fg='green', blink=True))
-                    for appointment in appointments:
-                        appointmentcheck = user + appointment.appointment_datetime + appointment.doctor_name
-                        click.echo(
-                            appointment.appointment_datetime + ' ' +
-                            click.style(appointment.doctor_name, fg='bright_green') + ' ' +
-                            appointment.clinic_name
-                        )
-                        #Pusover notifications message generation - will be generated only for newly found appointements
-                        if pushover_notification :
-                            try :
-                                # TODO: replace shelves with SQL as concurency will fail
-                                # TODO: crude workaround to create shelve if not existing 
-                                visistshelve = shelve.open('./visits.db')
-                                alreadynotified = appointmentcheck in list(visistshelve.values())
-                                visistshelve.close()
+        # all clinics and doctors go in a single request instead of one request per clinic/doctor pair
+        try:
+            appointments = med_session.search_appointments(
+                region=region, bookingtype=bookingtype, specialization=specialization, service=service, clinic=clinic, doctor=doctor, start_date=start_date)
+        except ReloginFailed:
+            echo_error('Unsuccessful logging in')
+            return
+
+        if not appointments:
+            click.echo(click.style(
+                f'(iteration: {counter}) No results found ' + pushover_msgtitle, fg='yellow'))
+        else:
+            applen = len(appointments)                    
+            click.echo(click.style(f'(iteration: {counter}) Found {applen} appointments ' + pushover_msgtitle, fg='green', blink=True))
+            visitsshelve = None
+            if pushover_notification :
+                try :
+                    # TODO: replace shelves with SQL as concurency will fail
+                    # shelve is opened once per iteration instead of twice per appointment
+                    visitsshelve = shelve.open('./visits.db', protocol=PICKLE_PROTOCOL)
+                except Exception:
+                    echo_error('Problem in Reading stored appointments')
+                    return
+            try:
+                for appointment in appointments:
+                    appointmentcheck = user + appointment.appointment_datetime + appointment.doctor_name
+                    click.echo(
+                        appointment.appointment_datetime + ' ' +
+                        click.style(appointment.doctor_name, fg='bright_green') + ' ' +
+                        appointment.clinic_name
+                    )
+                    #Pusover notifications message generation - will be generated only for newly found appointements
+                    if pushover_notification :
+                        # keys and values are the same, so a key lookup replaces scanning all stored values
+                        if appointmentcheck not in visitsshelve:
+                            notificationcounter += 1
+                            notification = notification + '<b>' + appointment.appointment_datetime + '</b> <font color="#0000ff">' + appointment.doctor_name + '</font> ' + appointment.clinic_name + '\n'
+                            try:
+                                visitsshelve[appointmentcheck] = appointmentcheck
                             except Exception:
-                                click.secho('Problem in Reading stored appointments', fg='red')
+                                echo_error('Problem in Writing appointments to storage')
                                 return
-
-                            if not alreadynotified:
-                                notificationcounter += 1
-                                notification = notification + '<b>' + appointment.appointment_datetime + '</b> <font color="#0000ff">' + appointment.doctor_name + '</font> ' + appointment.clinic_name + '\n'
-                                try:
-                                    visistshelve = shelve.open('./visits.db')
-                                    visistshelve[appointmentcheck] = appointmentcheck
-                                    visistshelve.close()
-                                except Exception:
-                                    click.secho('Problem in Writing appointments to storage', fg='red')
-                                    return
+            finally:
+                if visitsshelve is not None:
+                    visitsshelve.close()
 
         #Pushover notification final trim (max 1024 chars) and delivery
         if pushover_notification and notificationcounter > 0 :
@@ -133,28 +141,10 @@ def find_appointment(
     try :
         r = med_session.log_out()
     except Exception:
-        click.secho('Logout problems', fg='red')
+        echo_error('Logout problems')
         return
 
 
-def is_empty(any_structure):
-    if any_structure:
-        return False
-    else:
-        return True
-
-FIELD_NAMES = ['specialization', 'region', 'clinic', 'doctor']
-
-@click.command()
-@click.option('-f', '--field-name', type=click.Choice(FIELD_NAMES), default='specialization')
-def show_params(field_name):
-    params = load_available_search_params(field_name)
-    for p in params:
-        text = p['text']
-        id_ = p['id']
-        print(f' {text} (id={id_})')
-
-
 @click.group()
 def medihunter():
     pass
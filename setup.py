@@ -5,11 +5,14 @@ setup(
     version='0.1',
     py_modules=['medihunter'],
     include_package_data=True,
+    python_requires='>=3.7',
     install_requires=[
         'click',
         'requests',
         'beautifulsoup4',
+        'lxml',
         'python-pushover',
+        'orjson',
     ],
     entry_points='''
         [console_scripts]